@@ -1,24 +1,77 @@
 import argparse
 import csv
+import heapq
 import json
-from datetime import datetime, timedelta
+import os
+from datetime import datetime, timedelta, timezone
+import threading
 import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from dataclasses import dataclass
+from operator import attrgetter
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+try:
+    # Optional faster JSON codec; the standard library json module is used otherwise.
+    import orjson
+except ImportError:
+    orjson = None
 
 # DockerHub API configuration
 DH_API_BASE = "https://hub.docker.com/v2"
+# Values Docker Hub uses for timestamps that were never set (e.g. tags that were never pulled)
+EMPTY_DATES = frozenset({None, "", "0001-01-01T00:00:00Z", "0001-01-01T00:00:00.000000Z"})
+# Largest page size accepted by the Docker Hub API
+PAGE_SIZE = 100
+# Number of repositories whose tags are fetched in parallel
+FETCH_WORKERS = 8
+# Number of tag deletions issued in parallel
+DELETE_WORKERS = 8
+# Pause once the remaining request quota drops below this. Every worker may already have a request
+# in flight when the low quota is seen, so the threshold must leave room for all of them.
+RATE_LIMIT_THRESHOLD = FETCH_WORKERS + DELETE_WORKERS
 
-def parse_docker_date(date_str):
-    """Parse Docker Hub's timestamp format with variable fractional seconds."""
-    date_str = date_str.rstrip("Z")
-    if "." in date_str:
-        main_part, fractional = date_str.split(".", 1)
-        # Pad fractional part to 6 digits (Docker uses 4-6 digits)
-        fractional = fractional.ljust(6, "0")[:6]
-    else:
-        main_part = date_str
-        fractional = "000000"
-    return datetime.fromisoformat(f"{main_part}.{fractional}")
+# Shared by all worker threads so one low-quota response pauses every request, not just its own thread.
+_rate_limit_lock = threading.Lock()
+_rate_limit_resume_at = 0.0
+
+@dataclass(slots=True)
+class ProcessedTag:
+    """A tag's report fields plus the values computed to decide whether it is kept."""
+    name: str
+    last_updated_str: str
+    last_updated_key: str
+    last_pulled_str: str | None
+    last_pulled_key: str | None
+    status: str = ""
+    reason: str = ""
+
+def create_session(token):
+    """Build a Session that reuses connections to Docker Hub and retries transient failures."""
+    session = requests.Session()
+    # requests already advertises gzip/deflate via its default Accept-Encoding header.
+    session.headers.update({"Authorization": f"Bearer {token}", "Accept": "application/json"})
+    # Both calls the script makes are idempotent, so DELETEs are retried just like GETs.
+    retries = Retry(total=5, backoff_factor=0.5, status_forcelist=[429, 500, 502, 503, 504],
+                    allowed_methods=frozenset({"GET", "DELETE"}), raise_on_status=False)
+    adapter = HTTPAdapter(pool_connections=10, pool_maxsize=FETCH_WORKERS + DELETE_WORKERS, max_retries=retries)
+    session.mount("https://", adapter)
+    return session
+
+def json_loads(data):
+    """Decode JSON from str or bytes."""
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+def json_dumps(obj):
+    """Encode obj as compact JSON bytes."""
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj, separators=(",", ":")).encode("utf-8")
 
 def parse_args():
     parser = argparse.ArgumentParser(description="Docker Hub Tag Cleanup Script")
@@ -38,119 +91,210 @@ def parse_args():
     parser.add_argument("--report-file", default="cleanup_report.csv", help="Report file path")  # new argument
     return parser.parse_args()
 
-def get_paginated_results(url, headers, params=None):
+def _reset_delay(headers):
+    """Seconds until the rate limit window resets according to 'headers', or 1 if they do not say."""
+    try:
+        if "X-RateLimit-Reset" in headers:
+            # The Hub API reports the reset as a Unix timestamp rather than a delay.
+            return int(headers["X-RateLimit-Reset"]) - int(time.time())
+        return int(headers.get("RateLimit-Reset", "0").split(";")[0])
+    except ValueError:
+        return 1
+
+def _throttle(response):
+    """Pause all workers when the remaining quota runs low or Docker Hub answers 429."""
+    global _rate_limit_resume_at
+    headers = response.headers
+    if response.status_code == 429:
+        message = "Rate limit hit"
+        retry_after = headers.get("Retry-After", "")
+        wait = int(retry_after) if retry_after.isdigit() else _reset_delay(headers)
+    else:
+        remaining = headers.get("X-RateLimit-Remaining", headers.get("RateLimit-Remaining"))
+        if remaining is None:
+            return
+        # Values may carry a policy suffix, e.g. "100;w=21600". A malformed hint is ignored
+        # rather than allowed to abort the run.
+        try:
+            if int(remaining.split(";")[0]) >= RATE_LIMIT_THRESHOLD:
+                return
+        except ValueError:
+            return
+        message = "Rate limit nearly exhausted"
+        wait = _reset_delay(headers)
+    wait = max(1, wait)
+    with _rate_limit_lock:
+        resume_at = time.monotonic() + wait
+        if resume_at > _rate_limit_resume_at:
+            _rate_limit_resume_at = resume_at
+            print(f"{message}, pausing requests for {wait}s")
+
+def _wait_for_rate_limit():
+    """Block the calling worker while a rate limit pause is in effect."""
+    with _rate_limit_lock:
+        delay = _rate_limit_resume_at - time.monotonic()
+    if delay > 0:
+        time.sleep(delay)
+
+def get_paginated_results(url, session, params=None):
     results = []
     while url:
-        response = requests.get(url, headers=headers, params=params)
+        _wait_for_rate_limit()
+        response = session.get(url, params=params)
+        # The "next" URL already carries the query string, including page_size.
+        params = None
+        _throttle(response)
         response.raise_for_status()
-        data = response.json()
+        data = json_loads(response.content)
         results.extend(data["results"])
         url = data.get("next")
-        time.sleep(1)  # Rate limit protection
     return results
 
 def process_tags(tags, retention_days, global_preserve_last, preserve_rules):
     """
-    Process the tags list to compute parsed dates and determine preservation criteria.
+    Process the tags list to compute timestamp sort keys and determine preservation criteria.
     'preserve_rules' is a dict mapping a tag prefix to the number of tags to preserve for that prefix.
     If preserve_rules is empty, the global_preserve_last value is used.
-    Returns a list of tag dictionaries with additional computed fields.
+    Returns a list of ProcessedTag records.
     """
-    pull_cutoff = datetime.utcnow() - timedelta(days=retention_days)
+    pull_cutoff = datetime.now(timezone.utc) - timedelta(days=retention_days)
+    # Same shape as the tag sort keys, so the retention check is a string comparison.
+    pull_cutoff_key = pull_cutoff.strftime("%Y-%m-%dT%H:%M:%S.%f")
     processed = []
+    # Tags matching each counted prefix; only the newest N of each bucket are preserved.
+    matching = {prefix: [] for prefix, count in preserve_rules.items() if count is not None}
+    # Tuples let str.startswith reject tags that match no rule in one C-level call.
+    counted_prefixes = tuple(matching)
+    rule_prefixes = tuple(preserve_rules)
     
-    # Parse dates once and build a new collection with computed fields.
+    # Parse dates once and build a new collection with computed fields, bucketing by prefix as we go.
     for tag in tags:
         tag_name = tag.get("name")
         last_updated_str = tag.get("last_updated")
-        last_updated_dt = parse_docker_date(last_updated_str)
+        buckets = []
+        if tag_name.startswith(counted_prefixes):
+            buckets = [bucket for prefix, bucket in matching.items() if tag_name.startswith(prefix)]
         last_pulled_str = tag.get("tag_last_pulled")
-        last_pulled_dt = parse_docker_date(last_pulled_str) if last_pulled_str and last_pulled_str != "0001-01-01T00:00:00Z" else None
+        last_pulled_key = None if last_pulled_str in EMPTY_DATES else last_pulled_str.rstrip("Z")
         
-        processed.append({
-            "name": tag_name,
-            "last_updated_str": last_updated_str,
-            "last_updated_dt": last_updated_dt,
-            "last_pulled_str": last_pulled_str,
-            "last_pulled_dt": last_pulled_dt,
-            "original": tag  # Preserve original data for backup
-        })
-    
-    # Sort tags by last_updated_dt (newest first)
-    processed.sort(key=lambda x: x["last_updated_dt"], reverse=True)
-    
-    # Prepare a dictionary to track preserved tags and their preservation reasons.
-    preserved_reasons = {}
+        record = ProcessedTag(
+            name=tag_name,
+            last_updated_str=last_updated_str,
+            # Docker Hub timestamps are fixed-width UTC ISO 8601 up to the seconds, so without the
+            # trailing "Z" they order correctly as plain strings, whatever the fractional precision.
+            last_updated_key=last_updated_str.rstrip("Z"),
+            last_pulled_str=last_pulled_str,
+            last_pulled_key=last_pulled_key,
+        )
+        processed.append(record)
+        for bucket in buckets:
+            bucket.append(record)
     
+    # Only the newest N tags per rule matter, so pick them with a heap instead of sorting every tag.
+    by_last_updated = attrgetter("last_updated_key")
     if preserve_rules:
-        for prefix, count in preserve_rules.items():
-            matching = [tag for tag in processed if tag["name"].startswith(prefix)]
-            if count is None:
-                for tag in matching:
-                    preserved_reasons[tag["name"]] = f"preserved all for prefix '{prefix}'"
-            else:
-                for tag in matching[:count]:
-                    if tag["name"] not in preserved_reasons:
-                        preserved_reasons[tag["name"]] = f"top {count} for prefix '{prefix}'"
+        top_names = {
+            prefix: {tag.name for tag in heapq.nlargest(preserve_rules[prefix], bucket, key=by_last_updated)}
+            for prefix, bucket in matching.items()
+        }
     else:
-        for tag in processed[:global_preserve_last]:
-            if tag["name"] not in preserved_reasons:
-                preserved_reasons[tag["name"]] = f"top {global_preserve_last} newest tags"
+        newest_names = {tag.name for tag in heapq.nlargest(global_preserve_last, processed, key=by_last_updated)}
     
     for tag in processed:
+        preserved_reason = None
+        if not preserve_rules:
+            if tag.name in newest_names:
+                preserved_reason = f"top {global_preserve_last} newest tags"
+        elif tag.name.startswith(rule_prefixes):
+            for prefix, count in preserve_rules.items():
+                if count is None:
+                    if tag.name.startswith(prefix):
+                        preserved_reason = f"preserved all for prefix '{prefix}'"
+                elif preserved_reason is None and tag.name in top_names[prefix]:
+                    preserved_reason = f"top {count} for prefix '{prefix}'"
+        
         reasons = []
-        if tag["name"] in preserved_reasons:
-            reasons.append(preserved_reasons[tag["name"]])
-        if tag["last_pulled_dt"] and tag["last_pulled_dt"] >= pull_cutoff:
+        if preserved_reason:
+            reasons.append(preserved_reason)
+        if tag.last_pulled_key and tag.last_pulled_key >= pull_cutoff_key:
             reasons.append(f"pulled within retention ({retention_days} days)")
         
         if reasons:
-            tag["status"] = "PRESERVED"
-            tag["reason"] = ", ".join(reasons)
+            tag.status = "PRESERVED"
+            tag.reason = ", ".join(reasons)
         else:
             deletion_reasons = []
-            if not tag["last_pulled_dt"]:
+            if not tag.last_pulled_key:
                 deletion_reasons.append("never pulled")
             else:
                 deletion_reasons.append(f"not pulled since {pull_cutoff.isoformat()}")
-            tag["status"] = "TO DELETE"
-            tag["reason"] = ", ".join(deletion_reasons)
+            tag.status = "TO DELETE"
+            tag.reason = ", ".join(deletion_reasons)
     
     return processed
 
-def process_repository(repo_name, tags, args, preserve_rules, headers, writer):
+def delete_tag(delete_url, session):
+    _wait_for_rate_limit()
+    response = session.delete(delete_url)
+    _throttle(response)
+    response.raise_for_status()
+
+def report_deletions(pending_deletes, wait):
+    """
+    Print the outcome of finished deletions and drop them from 'pending_deletes', a dict mapping
+    futures to (repo_name, tag_name). If 'wait' is true, block until every deletion has finished.
+    Cancelled deletions were never sent and are dropped silently.
+    """
+    finished = as_completed(list(pending_deletes)) if wait else [f for f in pending_deletes if f.done()]
+    for future in finished:
+        repo_name, tag_name = pending_deletes.pop(future)
+        if future.cancelled():
+            continue
+        try:
+            future.result()
+            print(f"Deleted {repo_name}:{tag_name}")
+        except requests.RequestException as e:
+            print(f"Failed to delete {repo_name}:{tag_name} - {str(e)}")
+
+def process_repository(repo_name, tags, args, preserve_rules, session, writer, delete_executor, pending_deletes):
     processed_tags = process_tags(tags, args.retention_days, args.preserve_last, preserve_rules)
-    for tag in processed_tags:
-        writer.writerow([
-            repo_name,
-            tag["name"],
-            tag["last_pulled_str"],
-            tag["last_updated_str"],
-            tag["status"],
-            tag["reason"]
-        ])
-        if tag["status"] == "TO DELETE":
-            if args.dry_run:
-                print(f"[Dry Run] Would delete {repo_name}:{tag['name']}")
-            else:
-                delete_url = f"{DH_API_BASE}/repositories/{args.namespace}/{repo_name}/tags/{tag['name']}/"
-                try:
-                    response = requests.delete(delete_url, headers=headers)
-                    response.raise_for_status()
-                    print(f"Deleted {repo_name}:{tag['name']}")
-                    time.sleep(1)
-                except requests.HTTPError as e:
-                    print(f"Failed to delete {repo_name}:{tag['name']} - {str(e)}")
-
-def fetch_backup_data(args, headers):
-    backup_data = {}
+    # Report newest first, whatever order the tags were fetched or stored in.
+    processed_tags.sort(key=attrgetter("last_updated_key"), reverse=True)
+    # Write the whole repository's report rows in one call.
+    writer.writerows([
+        repo_name,
+        tag.name,
+        tag.last_pulled_str,
+        tag.last_updated_str,
+        tag.status,
+        tag.reason
+    ] for tag in processed_tags)
+    to_delete = [tag.name for tag in processed_tags if tag.status == "TO DELETE"]
+    if args.dry_run:
+        for tag_name in to_delete:
+            print(f"[Dry Run] Would delete {repo_name}:{tag_name}")
+        return
+    
+    # Queue deletions on the namespace-wide executor so they overlap with the following repositories.
+    tags_url = f"{DH_API_BASE}/repositories/{args.namespace}/{repo_name}/tags/"
+    for tag_name in to_delete:
+        delete_url = tags_url + tag_name + "/"
+        pending_deletes[delete_executor.submit(delete_tag, delete_url, session)] = (repo_name, tag_name)
+
+def fetch_backup_data(args, session):
+    """
+    Yield (repo_name, tags) pairs for the namespace's repositories.
+    Tag listings are fetched concurrently, but at most a small window of repositories is held in
+    memory at once and results are yielded in repository order.
+    """
     try:
         repos_url = f"{DH_API_BASE}/repositories/{args.namespace}/"
-        repos = get_paginated_results(repos_url, headers)
+        repos = get_paginated_results(repos_url, session, params={"page_size": PAGE_SIZE})
     except requests.HTTPError:
         repos_url = f"{DH_API_BASE}/users/{args.namespace}/repositories/"
-        repos = get_paginated_results(repos_url, headers)
+        repos = get_paginated_results(repos_url, session, params={"page_size": PAGE_SIZE})
     
+    repo_names = []
     for repo_data in repos:
         repo_name = repo_data["name"]
         # If --repos is provided, process only specified repos; otherwise, use skip-repos filtering.
@@ -158,31 +302,70 @@ def fetch_backup_data(args, headers):
             if repo_name not in args.repos:
                 continue
         else:
-            if any(repo_name.startswith(prefix) for prefix in args.skip_repos):
+            if repo_name.startswith(args.skip_repos):
                 print(f"Skipping repository: {repo_name}")
                 continue
-        tags_url = f"{DH_API_BASE}/repositories/{args.namespace}/{repo_name}/tags/"
-        try:
-            tags = get_paginated_results(tags_url, headers)
-        except requests.HTTPError as e:
-            print(f"Error fetching tags for {repo_name}: {str(e)}")
-            continue
-        backup_data[repo_name] = tags
-    return backup_data
+        repo_names.append(repo_name)
+
+    with ThreadPoolExecutor(max_workers=FETCH_WORKERS) as executor:
+        pending = deque()
+        remaining = iter(repo_names)
+
+        def submit_next():
+            repo_name = next(remaining, None)
+            if repo_name is not None:
+                tags_url = f"{DH_API_BASE}/repositories/{args.namespace}/{repo_name}/tags/"
+                future = executor.submit(get_paginated_results, tags_url, session, {"page_size": PAGE_SIZE})
+                pending.append((repo_name, future))
+
+        for _ in range(2 * FETCH_WORKERS):
+            submit_next()
+        while pending:
+            repo_name, future = pending.popleft()
+            submit_next()
+            try:
+                tags = future.result()
+            except requests.HTTPError as e:
+                print(f"Error fetching tags for {repo_name}: {str(e)}")
+                continue
+            yield repo_name, tags
 
 def load_backup_data(args):
-    with open(args.input_json, "r") as f:
-        return json.load(f)
+    """
+    Yield (repo_name, tags) pairs from a backup file.
+    Accepts the JSON Lines format written by this script ({"repo": ..., "tags": [...]} per line)
+    as well as older backups holding a single {repo_name: tags} object.
+    """
+    with open(args.input_json, "rb") as f:
+        first_line = f.readline()
+        try:
+            record = json_loads(first_line)
+        except ValueError:
+            record = None
+        if not (isinstance(record, dict) and record.keys() == {"repo", "tags"}):
+            f.seek(0)
+            data = f.read()
+            # An empty file is the JSON Lines backup of a run that found no repositories.
+            if data.strip():
+                yield from json_loads(data).items()
+            return
+        yield record["repo"], record["tags"]
+        for line in f:
+            if line.strip():
+                record = json_loads(line)
+                yield record["repo"], record["tags"]
 
-def get_backup_data(args, headers):
+def get_backup_data(args, session):
     if args.input_json:
         print(f"Loading backup data from {args.input_json} ...")
         return load_backup_data(args)
     else:
-        return fetch_backup_data(args, headers)
+        return fetch_backup_data(args, session)
 
 def main():
     args = parse_args()
+    # str.startswith accepts a tuple, matching all skip prefixes in a single call.
+    args.skip_repos = tuple(args.skip_repos)
     
     # Parse the preservation rules into a dictionary.
     # Expected format: prefix:number (e.g., prod:10 staging:5)
@@ -194,33 +377,67 @@ def main():
         else:
             preserve_rules[rule] = None
 
-    headers = {"Authorization": f"Bearer {args.token}"}
+    session = create_session(args.token)
     
-    with open(args.report_file, "w", newline="") as csvfile:  # use report file from argument
-        writer = csv.writer(csvfile)
-        writer.writerow(["Repository", "Tag", "Last Pulled", "Last Updated", "Status", "Reason"])
-        
-        backup_data = get_backup_data(args, headers)
-        
-        # Filter backup_data if specific repositories are provided via --repos
-        if args.repos:
-            backup_data = {repo: tags for repo, tags in backup_data.items() if repo in args.repos}
-            if not backup_data:
+    # Backup data is only written when it is fetched from the API. It goes to a temporary file that
+    # replaces the previous backup only once the run succeeds, and that file is created only when the
+    # first repository arrives, so a run that fails early leaves no stray file behind.
+    backup_tmp_path = f"{args.backup_file}.tmp"
+    backup_file = None
+    try:
+        with open(args.report_file, "w", newline="", buffering=1 << 20) as csvfile:  # use report file from argument
+            writer = csv.writer(csvfile)
+            writer.writerow(["Repository", "Tag", "Last Pulled", "Last Updated", "Status", "Reason"])
+            
+            # Repositories are processed one at a time so only a single repository's tags are held in memory.
+            processed_any = False
+            with ThreadPoolExecutor(max_workers=DELETE_WORKERS) as delete_executor:
+                pending_deletes = {}
+                try:
+                    for repo_name, tags in get_backup_data(args, session):
+                        # Filter backup data if specific repositories are provided via --repos;
+                        # use skip-repos only when --repos is not provided.
+                        if args.repos:
+                            if repo_name not in args.repos:
+                                continue
+                        elif repo_name.startswith(args.skip_repos):
+                            print(f"Skipping repository: {repo_name}")
+                            continue
+                        processed_any = True
+                        if not args.input_json:
+                            if backup_file is None:
+                                backup_file = open(backup_tmp_path, "wb")
+                            backup_file.write(json_dumps({"repo": repo_name, "tags": tags}) + b"\n")
+                            backup_file.flush()
+                        process_repository(repo_name, tags, args, preserve_rules, session, writer,
+                                           delete_executor, pending_deletes)
+                        report_deletions(pending_deletes, wait=False)
+                        csvfile.flush()
+                    report_deletions(pending_deletes, wait=True)
+                except BaseException:
+                    # Cancel deletions that have not started, wait for the ones in flight and report them.
+                    # (as_completed never returns for futures cancelled by shutdown, so do not wait here.)
+                    delete_executor.shutdown(cancel_futures=True)
+                    report_deletions(pending_deletes, wait=False)
+                    raise
+            
+            if args.repos and not processed_any:
                 print("No matching repositories found in backup data for the provided --repos argument.")
                 return
-        
-        # Process each repository's backup data; use skip-repos only when --repos is not provided.
-        for repo_name, tags in backup_data.items():
-            if not args.repos and any(repo_name.startswith(prefix) for prefix in args.skip_repos):
-                print(f"Skipping repository: {repo_name}")
-                continue
-            process_repository(repo_name, tags, args, preserve_rules, headers, writer)
-        
-        # Save backup data if it was fetched from the API.
-        if not args.input_json:
-            with open(args.backup_file, "w") as f:
-                json.dump(backup_data, f, indent=2)
-            print(f"Backup saved to {args.backup_file}")
+    except BaseException:
+        if backup_file is not None:
+            backup_file.close()
+            print(f"Run did not complete; previous backup left untouched, partial backup at {backup_tmp_path}")
+        raise
+    
+    if args.input_json:
+        return
+    if backup_file is None:
+        # Every repository was skipped or the namespace is empty; an empty backup still records that.
+        backup_file = open(backup_tmp_path, "wb")
+    backup_file.close()
+    os.replace(backup_tmp_path, args.backup_file)
+    print(f"Backup saved to {args.backup_file}")
 
 if __name__ == "__main__":
     main()
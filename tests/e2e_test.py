@@ -1,29 +1,224 @@
+import contextlib
+import csv
+import io
+import json
 import os
+import re
 import subprocess
 import sys  # Import sys to access sys.executable
+import tempfile
+import threading
+import time
 import unittest
+from concurrent.futures import Future
+from datetime import datetime, timedelta, timezone
+from types import SimpleNamespace
+from unittest import mock
+
+import requests
+
+BASE_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+SCRIPT_PATH = os.path.join(BASE_DIR, "dockerhub_cleanup.py")
+MOCK_PATH = os.path.join(os.path.dirname(__file__), "dockerhub_backup_mock.json")
+
+sys.path.insert(0, BASE_DIR)
+import dockerhub_cleanup  # noqa: E402
 
 class TestDockerhubCleanupE2E(unittest.TestCase):
-    def test_cleanup_dry_run(self):
-        base_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
-        script_path = os.path.join(base_dir, "dockerhub_cleanup.py")
-        input_json_path = os.path.join(os.path.dirname(__file__), "dockerhub_backup_mock.json")
+    def setUp(self):
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        self.tmp_dir = tmp_dir.name
+
+    def run_cleanup(self, input_json_path, *extra_args, report_name="report.csv"):
+        """Run the script in dry-run mode and return (completed process, report rows)."""
+        report_path = os.path.join(self.tmp_dir, report_name)
         cmd = [
             sys.executable,  # Use the same Python interpreter as the test
-            script_path,
+            SCRIPT_PATH,
             "--namespace", "testnamespace",
             "--token", "dummy",
             "--dry-run",
             "--input-json", input_json_path,
-            "--preserve", "pr-001:1", "pr-002:1"
+            "--report-file", report_path,
+            *extra_args
         ]
         result = subprocess.run(cmd, capture_output=True, text=True)
         self.assertEqual(result.returncode, 0, msg=f"Exit code: {result.returncode}; stderr: {result.stderr}")
+        with open(report_path, newline="") as f:
+            rows = list(csv.reader(f))
+        return result, rows
+
+    def write_backup(self, backup_data):
+        """Write a {repo_name: tags} backup to the temporary directory and return its path."""
+        path = os.path.join(self.tmp_dir, "generated_backup.json")
+        with open(path, "w") as f:
+            json.dump(backup_data, f)
+        return path
+
+    def test_retention_window_timestamp_precisions(self):
+        now = datetime.now(timezone.utc)
+        never = "0001-01-01T00:00:00Z"
+        tags = [
+            # Whole-second and millisecond timestamps inside the 30 day window, one just outside it.
+            {"name": "pulled-whole-second", "last_updated": "2023-01-01T00:00:00Z",
+             "tag_last_pulled": (now - timedelta(days=1)).strftime("%Y-%m-%dT%H:%M:%SZ")},
+            {"name": "pulled-millis", "last_updated": "2023-01-01T00:00:00Z",
+             "tag_last_pulled": (now - timedelta(days=2)).strftime("%Y-%m-%dT%H:%M:%S.%f")[:-3] + "Z"},
+            {"name": "pulled-outside", "last_updated": "2023-01-01T00:00:00Z",
+             "tag_last_pulled": (now - timedelta(days=30, hours=1)).strftime("%Y-%m-%dT%H:%M:%SZ")},
+            {"name": "never-pulled", "last_updated": "2023-01-01T00:00:00Z", "tag_last_pulled": never},
+        ]
+        _, rows = self.run_cleanup(self.write_backup({"repo": tags}), "--retention-days", "30", "--preserve-last", "0")
+        report = {row[1]: (row[4], row[5]) for row in rows[1:]}
+        self.assertEqual(report["pulled-whole-second"], ("PRESERVED", "pulled within retention (30 days)"))
+        self.assertEqual(report["pulled-millis"], ("PRESERVED", "pulled within retention (30 days)"))
+        self.assertEqual(report["pulled-outside"][0], "TO DELETE")
+        self.assertTrue(report["pulled-outside"][1].startswith("not pulled since"))
+        self.assertEqual(report["never-pulled"], ("TO DELETE", "never pulled"))
+
+    def test_preserve_last_ranks_mixed_precision_timestamps(self):
+        never = "0001-01-01T00:00:00Z"
+        # All within the same couple of seconds; precision varies from none to microseconds.
+        tags = [
+            {"name": "whole-second", "last_updated": "2024-05-01T10:00:17Z", "tag_last_pulled": never},
+            {"name": "one-digit", "last_updated": "2024-05-01T10:00:17.5Z", "tag_last_pulled": never},
+            {"name": "two-digits", "last_updated": "2024-05-01T10:00:17.52Z", "tag_last_pulled": never},
+            {"name": "previous-second", "last_updated": "2024-05-01T10:00:16.999999Z", "tag_last_pulled": never},
+        ]
+        _, rows = self.run_cleanup(self.write_backup({"repo": tags}), "--preserve-last", "2")
+        status = {row[1]: row[4] for row in rows[1:]}
+        self.assertEqual(status, {
+            "two-digits": "PRESERVED",
+            "one-digit": "PRESERVED",
+            "whole-second": "TO DELETE",
+            "previous-second": "TO DELETE",
+        })
+        # Report rows are listed newest first, not in backup order.
+        self.assertEqual([row[1] for row in rows[1:]], ["two-digits", "one-digit", "whole-second", "previous-second"])
+
+    def test_cleanup_dry_run(self):
+        result, _ = self.run_cleanup(MOCK_PATH, "--preserve", "pr-001:1", "pr-002:1")
         print(result.stdout)
         self.assertIn("Dry Run", result.stdout)
         self.assertIn("Would delete", result.stdout)
         self.assertNotIn("pr-001", result.stdout)
         self.assertNotIn("pr-002", result.stdout)
 
+    def test_cleanup_dry_run_json_lines_backup(self):
+        with open(MOCK_PATH) as f:
+            backup_data = json.load(f)
+        # Backups written by the script hold one {"repo": ..., "tags": [...]} record per line.
+        input_json_path = os.path.join(self.tmp_dir, "backup.json")
+        with open(input_json_path, "w") as f:
+            for repo_name, tags in backup_data.items():
+                f.write(json.dumps({"repo": repo_name, "tags": tags}) + "\n")
+
+        preserve = ["--preserve", "pr-001:1", "pr-002:1"]
+        legacy_result, legacy_rows = self.run_cleanup(MOCK_PATH, *preserve, report_name="legacy.csv")
+        result, rows = self.run_cleanup(input_json_path, *preserve, report_name="json_lines.csv")
+        # Every repository from the JSON Lines file must be reported exactly as from the legacy file.
+        # The reason column embeds the run's retention cutoff time, so that part is normalised.
+        def normalise(report_rows):
+            return [row[:5] + [re.sub(r"not pulled since .*", "not pulled since <cutoff>", row[5])]
+                    for row in report_rows]
+        self.assertEqual({row[0] for row in rows[1:]}, set(backup_data))
+        self.assertEqual(normalise(rows), normalise(legacy_rows))
+        self.assertEqual(result.stdout.splitlines()[1:], legacy_result.stdout.splitlines()[1:])
+
+class TestRateLimitThrottle(unittest.TestCase):
+    def setUp(self):
+        dockerhub_cleanup._rate_limit_resume_at = 0.0
+        self.addCleanup(setattr, dockerhub_cleanup, "_rate_limit_resume_at", 0.0)
+
+    def throttle(self, status_code, headers):
+        """Call _throttle with a stub response and return (pause in seconds, printed output)."""
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            dockerhub_cleanup._throttle(SimpleNamespace(status_code=status_code, headers=headers))
+        return dockerhub_cleanup._rate_limit_resume_at - time.monotonic(), output.getvalue()
+
+    def test_unparsable_retry_after_pauses_briefly(self):
+        for retry_after in ["", "r=1", "Wed, 21 Oct 2015 07:28:00 GMT"]:
+            with self.subTest(retry_after=retry_after):
+                dockerhub_cleanup._rate_limit_resume_at = 0.0
+                pause, output = self.throttle(429, {"Retry-After": retry_after})
+                self.assertAlmostEqual(pause, 1, delta=0.5)
+                self.assertIn("Rate limit hit", output)
+
+    def test_429_without_retry_after_waits_for_reset(self):
+        pause, _ = self.throttle(429, {"X-RateLimit-Reset": str(int(time.time()) + 30)})
+        self.assertAlmostEqual(pause, 30, delta=1.5)
+
+    def test_unparsable_remaining_is_ignored(self):
+        pause, output = self.throttle(200, {"X-RateLimit-Remaining": "r=1", "X-RateLimit-Reset": "soon"})
+        self.assertLessEqual(pause, 0)
+        self.assertEqual(output, "")
+
+    def test_low_remaining_with_unparsable_reset_pauses_briefly(self):
+        pause, output = self.throttle(200, {"X-RateLimit-Remaining": "0", "X-RateLimit-Reset": "soon"})
+        self.assertAlmostEqual(pause, 1, delta=0.5)
+        self.assertIn("Rate limit nearly exhausted", output)
+
+class TestDeletionReporting(unittest.TestCase):
+    def test_report_deletions_outcomes(self):
+        deleted, failed, cancelled = Future(), Future(), Future()
+        deleted.set_result(None)
+        failed.set_exception(requests.ConnectionError("connection reset"))
+        cancelled.cancel()
+        pending = {deleted: ("repo", "deleted"), failed: ("repo", "failed"), cancelled: ("repo", "cancelled")}
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            dockerhub_cleanup.report_deletions(pending, wait=False)
+        self.assertEqual(pending, {})
+        self.assertEqual(sorted(output.getvalue().splitlines()), [
+            "Deleted repo:deleted",
+            "Failed to delete repo:failed - connection reset",
+        ])
+
+    def test_abort_cancels_queued_deletions(self):
+        never = "0001-01-01T00:00:00Z"
+        first_delete_started = threading.Event()
+        sent_deletes = []
+
+        class AbortingSession:
+            """Lists repositories 'a' and 'b'; fetching b's tags fails once a's first deletion is in flight."""
+            def get(self, url, params=None):
+                if url.endswith("/repositories/testnamespace/"):
+                    data = {"results": [{"name": "a"}, {"name": "b"}], "next": None}
+                elif "/b/tags/" in url:
+                    first_delete_started.wait(5)
+                    raise requests.ConnectionError("connection reset")
+                else:
+                    data = {"results": [{"name": f"tag-{i}", "last_updated": "2023-01-01T00:00:00Z",
+                                         "tag_last_pulled": never} for i in range(5)], "next": None}
+                return SimpleNamespace(status_code=200, headers={}, content=json.dumps(data).encode(),
+                                       raise_for_status=lambda: None)
+
+            def delete(self, url):
+                sent_deletes.append(url)
+                first_delete_started.set()
+                # Stay in flight while the run aborts.
+                time.sleep(0.2)
+                return SimpleNamespace(status_code=204, headers={}, raise_for_status=lambda: None)
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            argv = ["dockerhub_cleanup.py", "--namespace", "testnamespace", "--token", "dummy",
+                    "--preserve-last", "0",
+                    "--backup-file", os.path.join(tmp_dir, "backup.json"),
+                    "--report-file", os.path.join(tmp_dir, "report.csv")]
+            output = io.StringIO()
+            with mock.patch.object(sys, "argv", argv), \
+                    mock.patch.object(dockerhub_cleanup, "create_session", lambda token: AbortingSession()), \
+                    mock.patch.object(dockerhub_cleanup, "DELETE_WORKERS", 1), \
+                    contextlib.redirect_stdout(output), \
+                    self.assertRaises(requests.ConnectionError):
+                dockerhub_cleanup.main()
+            self.assertFalse(os.path.exists(os.path.join(tmp_dir, "backup.json")))
+        # Only the deletion already in flight is sent and reported; the queued ones are dropped.
+        self.assertEqual(len(sent_deletes), 1)
+        deletion_lines = [line for line in output.getvalue().splitlines() if "delete" in line.lower()]
+        self.assertEqual(deletion_lines, ["Deleted a:tag-0"])
+
 if __name__ == "__main__":
     unittest.main()